@@ -4,14 +4,29 @@ import subprocess
 import random
 from zipfile import ZipFile
 import uuid
+import tempfile
 import time
+import functools
+import hashlib
+import collections
+import atexit
+import shutil
+import queue
+import threading
+
+# The async allocator avoids the cudaMalloc stalls seen while the GPT cache grows, has to be set before torch loads.
+# It has no private pools/checkpointing, which cudagraph trees rely on, so torch.compile below must not use
+# cudagraphs (no backend="cudagraphs", mode="reduce-overhead" or mode="max-autotune").
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "backend:cudaMallocAsync")
+
+import numpy as np
 import torch
 import torchaudio
+import soundfile
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 
 
-#download for mecab
-os.system('python -m unidic download')
-
 # By using XTTS you agree to CPML license https://coqui.ai/cpml
 os.environ["COQUI_TOS_AGREED"] = "1"
 
@@ -25,57 +40,429 @@ import datetime
 import re
 
 import gradio as gr
+from gradio import processing_utils
 from scipy.io.wavfile import write
 from pydub import AudioSegment
 
-from TTS.api import TTS
-from TTS.tts.configs.xtts_config import XttsConfig
-from TTS.tts.models.xtts import Xtts
-from TTS.utils.generic_utils import get_user_data_dir
-
 HF_TOKEN = os.environ.get("HF_TOKEN")
 
+# XTTS_INT8=1 quantizes the GPT blocks to int8 with bitsandbytes, to A/B against the default fp16 path
+XTTS_INT8 = os.environ.get("XTTS_INT8") == "1"
+# TRT_ENABLED=1 serves the HiFi-GAN decoder through onnxruntime's TensorRT provider
+TRT_ENABLED = os.environ.get("TRT_ENABLED") == "1"
+
 from huggingface_hub import HfApi
 
 # will use api to restart space on a unrecoverable error
 api = HfApi(token=HF_TOKEN)
 repo_id = "coqui/xtts"
 
-# Use never ffmpeg binary for Ubuntu20 to use denoising for microphone input
-print("Export newer ffmpeg binary for denoise filter")
-ZipFile("ffmpeg.zip").extractall()
-print("Make ffmpeg binary executable")
-st = os.stat("ffmpeg")
-os.chmod("ffmpeg", st.st_mode | stat.S_IEXEC)
-
-# This will trigger downloading model
-print("Downloading if not downloaded Coqui XTTS V2")
-from TTS.utils.manage import ModelManager
-
-model_name = "tts_models/multilingual/multi-dataset/xtts_v2"
-ModelManager().download_model(model_name)
-model_path = os.path.join(get_user_data_dir("tts"), model_name.replace("/", "--"))
-print("XTTS downloaded")
-
-config = XttsConfig()
-config.load_json(os.path.join(model_path, "config.json"))
-
-model = Xtts.init_from_config(config)
-model.load_checkpoint(
-    config,
-    checkpoint_path=os.path.join(model_path, "model.pth"),
-    vocab_path=os.path.join(model_path, "vocab.json"),
-    eval=True,
-    use_deepspeed=True,
-)
-model.cuda()
+# Filtered reference audio is only read back once, keep it on memory backed storage where available.
+# That storage is RAM, so files are deleted once they drop out of the cleanup cache and the dir on exit
+SCRATCH_DIR = tempfile.mkdtemp(dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+atexit.register(shutil.rmtree, SCRATCH_DIR, ignore_errors=True)
 
 # This is for debugging purposes only
 DEVICE_ASSERT_DETECTED = 0
 DEVICE_ASSERT_PROMPT = None
 DEVICE_ASSERT_LANG = None
 
-supported_languages = config.languages
+def _file_digest(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+# Conditioning latents are the most expensive part of a request and only depend on the reference audio.
+# Gradio rewrites the reference to the same path with a new mtime on every request, so they are cached per
+# file content rather than per path. Only used from the GPU worker (and get_model before it starts), so no lock.
+LATENTS_CACHE_SIZE = 32
+latents_cache = collections.OrderedDict()
+
+
+def _get_latents(speaker_wav_path, digest):
+    """Conditioning latents of the reference audio, digest is the _file_digest of the file"""
+    if digest in latents_cache:
+        latents_cache.move_to_end(digest)
+        return latents_cache[digest]
+    latents = model.get_conditioning_latents(audio_path=speaker_wav_path, gpt_cond_len=30, gpt_cond_chunk_len=4, max_ref_length=60)
+    latents_cache[digest] = latents
+    while len(latents_cache) > LATENTS_CACHE_SIZE:
+        latents_cache.popitem(last=False)
+    return latents
+
+# Latents of the bundled example voices, computed at startup. Keyed by file content, of the example itself
+# (API callers passing its path) and of the copy gradio hands predict when it is picked in the UI
+PRECOMPUTED = {}
+
+
+def _gradio_reference_digest(path):
+    """Digest of the file Audio(type="filepath") passes to predict for this audio, gradio decodes and re-encodes it"""
+    sample_rate, data = processing_utils.audio_from_file(path, crop_min=0, crop_max=100)
+    with tempfile.TemporaryDirectory(dir=SCRATCH_DIR) as tmp:
+        normalised = os.path.join(tmp, "reference.wav")
+        processing_utils.audio_to_file(sample_rate, data, normalised, format="wav")
+        return _file_digest(normalised)
+
+# Filtering for microphone input, as it has BG noise, maybe silence in beginning and end
+# This is fast filtering not perfect.
+# The filtered file is cached per source content (gradio rewrites the reference with a new mtime every request),
+# so a reused reference skips ffmpeg and, as the filtered file is then the same too, also hits the latents cache
+CLEANED_REFERENCES_SIZE = 32
+cleaned_references = collections.OrderedDict()
+cleaned_references_lock = threading.Lock()
+
+
+def _cleanup_reference(speaker_wav_path, digest):
+    """Filtered copy of the reference audio, digest is the _file_digest of the file"""
+    with cleaned_references_lock:
+        if digest in cleaned_references:
+            cleaned_references.move_to_end(digest)
+            return cleaned_references[digest]
+
+    out_filename = _filter_reference(speaker_wav_path)
+
+    with cleaned_references_lock:
+        if digest in cleaned_references:
+            # another request filtered the same file meanwhile, keep theirs
+            os.remove(out_filename)
+            return cleaned_references[digest]
+        cleaned_references[digest] = out_filename
+        while len(cleaned_references) > CLEANED_REFERENCES_SIZE:
+            _, evicted = cleaned_references.popitem(last=False)
+            if os.path.exists(evicted):
+                os.remove(evicted)
+    return out_filename
+
+
+def _filter_reference(speaker_wav_path):
+    # Apply all on demand
+    lowpassfilter = denoise = trim = loudness = True
+
+    if lowpassfilter:
+        lowpass_highpass = "lowpass=8000,highpass=75,"
+    else:
+        lowpass_highpass = ""
+
+    if trim:
+        # better to remove silence in beginning and end for microphone
+        trim_silence = "areverse,silenceremove=start_periods=1:start_silence=0:start_threshold=0.02,areverse,silenceremove=start_periods=1:start_silence=0:start_threshold=0.02,"
+    else:
+        trim_silence = ""
+
+    out_filename = os.path.join(
+        SCRATCH_DIR, str(uuid.uuid4()) + ".wav"
+    )  # ffmpeg to know output format
+
+    # we will use newer ffmpeg as that has afftn denoise filter
+    shell_command = f"./ffmpeg -y -i {speaker_wav_path} -af {lowpass_highpass}{trim_silence} {out_filename}".split(
+        " "
+    )
+
+    try:
+        subprocess.run(
+            [item for item in shell_command],
+            capture_output=False,
+            text=True,
+            check=True,
+        )
+    except subprocess.CalledProcessError:
+        # don't leave a partial output behind in the scratch dir
+        if os.path.exists(out_filename):
+            os.remove(out_filename)
+        raise
+    return out_filename
+
+# All model work, conditioning latents as well as generation, runs on this single GPU worker thread in arrival
+# order. XTTS inference only takes one text at a time so requests are not batched; the gradio queue runs
+# QUEUE_CONCURRENCY predict calls at once so their CPU side (language checks, reference cleanup) overlaps.
+QUEUE_CONCURRENCY = 4
+inference_queue = queue.Queue()
+
+
+class SpeakerEncodingError(Exception):
+    """The reference audio could not be turned into conditioning latents"""
+
+
+def _inference_worker():
+    while True:
+        prompt, language, speaker_wav, chunk_queue, cancelled = inference_queue.get()
+        if cancelled.is_set():
+            continue
+        try:
+            # note diffusion_conditioning not used on hifigan (default mode), it will be empty but need to pass it to model.inference
+            try:
+                digest = _file_digest(speaker_wav)
+                if digest in PRECOMPUTED:
+                    gpt_cond_latent, speaker_embedding = PRECOMPUTED[digest]
+                else:
+                    gpt_cond_latent, speaker_embedding = _get_latents(speaker_wav, digest)
+            except Exception as e:
+                raise SpeakerEncodingError(str(e)) from e
+
+            # With deepspeed, TTS already halves gpt_inference itself. The rest of the model stays fp32 as the same
+            # modules also compute the conditioning latents from fp32 mel/audio; autocast runs their matmuls and
+            # convs in fp16 per op while keeping norms and reductions in fp32, without casting at every entry point.
+            with torch.inference_mode(), torch.autocast("cuda", dtype=torch.float16):
+                chunks = model.inference_stream(
+                    prompt,
+                    language,
+                    gpt_cond_latent,
+                    speaker_embedding,
+                    stream_chunk_size=20,
+                    repetition_penalty=5.0,
+                    temperature=0.75,
+                )
+                for chunk in chunks:
+                    # nobody is listening anymore (e.g. the client disconnected), free the GPU for the next request
+                    if cancelled.is_set():
+                        chunks.close()
+                        break
+                    chunk_queue.put(chunk.float().cpu())
+            chunk_queue.put(None)
+        except Exception as e:
+            chunk_queue.put(e)
+
+
+def _load_audio(audiopath, sampling_rate):
+    """Drop-in for the XTTS reference loader: soundfile decodes wav cheaply and the resampling runs on the GPU"""
+    try:
+        wav, lsr = soundfile.read(audiopath, dtype="float32", always_2d=True)
+        audio = torch.from_numpy(wav.T)
+    except RuntimeError:
+        # formats libsndfile cannot read (e.g. mp3 uploads) still go through torchaudio
+        audio, lsr = torchaudio.load(audiopath)
+    audio = audio.cuda()
+    # stereo to mono if needed
+    if audio.size(0) != 1:
+        audio = torch.mean(audio, dim=0, keepdim=True)
+    if lsr != sampling_rate:
+        audio = torchaudio.functional.resample(audio, lsr, sampling_rate)
+    audio.clip_(-1, 1)
+    return audio
+
+
+def load_model():
+    """Download and set up XTTS for inference, the TTS imports are deferred to here as they are slow"""
+    #download for mecab, the dictionary persists on disk so only fetch it once
+    import unidic
+
+    if not os.path.exists(os.path.join(unidic.DICDIR, "mecabrc")):
+        os.system('python -m unidic download')
+
+    # Use never ffmpeg binary for Ubuntu20 to use denoising for microphone input
+    if not os.path.exists("ffmpeg"):
+        print("Export newer ffmpeg binary for denoise filter")
+        ZipFile("ffmpeg.zip").extractall()
+    print("Make ffmpeg binary executable")
+    st = os.stat("ffmpeg")
+    os.chmod("ffmpeg", st.st_mode | stat.S_IEXEC)
+
+    # This will trigger downloading model
+    print("Downloading if not downloaded Coqui XTTS V2")
+    from TTS.utils.generic_utils import get_user_data_dir
+    from TTS.utils.manage import ModelManager
+
+    model_name = "tts_models/multilingual/multi-dataset/xtts_v2"
+    ModelManager().download_model(model_name)
+    model_path = os.path.join(get_user_data_dir("tts"), model_name.replace("/", "--"))
+    print("XTTS downloaded")
+
+    from TTS.tts.configs.xtts_config import XttsConfig
+    from TTS.tts.models import xtts
+    from TTS.tts.models.xtts import Xtts
+
+    # get_conditioning_latents reads the reference through this module level function
+    xtts.load_audio = _load_audio
+
+    # deepspeed fuses the GPT decoder kernels, fall back to eager mode where it is not installable (e.g. Windows).
+    # Its fused kernels replace the GPT blocks, so it is not used together with int8 quantization.
+    try:
+        import deepspeed
+        use_deepspeed = not XTTS_INT8
+    except ImportError:
+        print("deepspeed not available, running XTTS without it")
+        use_deepspeed = False
+
+    config = XttsConfig()
+    config.load_json(os.path.join(model_path, "config.json"))
+
+    model = Xtts.init_from_config(config)
+    model.load_checkpoint(
+        config,
+        checkpoint_path=os.path.join(model_path, "model.pth"),
+        vocab_path=os.path.join(model_path, "vocab.json"),
+        eval=True,
+        use_deepspeed=use_deepspeed,
+    )
+    model.cuda()
+    # leave some headroom on the device for the allocator pool and other processes
+    torch.cuda.set_per_process_memory_fraction(0.9)
+
+    if XTTS_INT8:
+        import bitsandbytes as bnb
+        from transformers.pytorch_utils import Conv1D
+
+        # HF GPT2 blocks use Conv1D (a transposed linear) for their projections, swap them for int8 linears.
+        # The HiFi-GAN decoder is left alone, quantizing the vocoder hurts audio quality.
+        print("Quantizing XTTS GPT to int8")
+        for block in model.gpt.gpt.h:
+            for parent in [block.attn, block.mlp]:
+                for name, conv in list(parent.named_children()):
+                    if not isinstance(conv, Conv1D):
+                        continue
+                    in_features, out_features = conv.weight.shape
+                    linear = bnb.nn.Linear8bitLt(in_features, out_features, bias=True, has_fp16_weights=False, threshold=6.0)
+                    linear.weight = bnb.nn.Int8Params(
+                        conv.weight.data.t().contiguous().cpu(), requires_grad=False, has_fp16_weights=False
+                    )
+                    linear.bias = torch.nn.Parameter(conv.bias.data.cpu(), requires_grad=False)
+                    setattr(parent, name, linear.cuda())
+
+    # Let fp32 matmuls/convs use tensor cores, and pick the fastest cuDNN kernels for our shapes
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cudnn.benchmark = True
+    torch.set_float32_matmul_precision("high")
+
+    # Compiling removes the python/kernel-launch overhead of the per-token GPT forward and the vocoder.
+    # The deepspeed-injected GPT does not trace and the bitsandbytes int8 layers do not either,
+    # so only compile the GPT when running it eagerly in full precision.
+    if torch.cuda.is_available():
+        if not use_deepspeed and not XTTS_INT8:
+            # Token by token generation (including inference_stream) calls gpt_inference, compiling its forward once
+            # fuses the layernorm/projection/attention kernels of all blocks in a single graph.
+            # The KV cache grows every step, so shapes are dynamic from the start instead of recompiling per length.
+            model.gpt.gpt_inference.forward = torch.compile(model.gpt.gpt_inference.forward, dynamic=True)
+        if not TRT_ENABLED:
+            # in streaming the decoder gets all latents generated so far, so its input length changes every chunk
+            model.hifigan_decoder = torch.compile(model.hifigan_decoder, dynamic=True)
+
+    # Optionally serve the HiFi-GAN decoder through onnxruntime's TensorRT provider
+    if TRT_ENABLED:
+        import onnxruntime
+
+        onnx_path = os.path.join(model_path, "hifigan_decoder.onnx")
+        if not os.path.exists(onnx_path):
+            print("Exporting HiFi-GAN decoder to ONNX")
+            dummy_latents = torch.randn(1, 32, config.model_args.decoder_input_dim, device="cuda")
+            dummy_g = torch.randn(1, config.model_args.d_vector_dim, 1, device="cuda")
+            torch.onnx.export(
+                model.hifigan_decoder,
+                (dummy_latents, {"g": dummy_g}),
+                onnx_path,
+                input_names=["latents", "g"],
+                output_names=["wav"],
+                dynamic_axes={"latents": {1: "T"}, "wav": {2: "samples"}},
+                opset_version=17,
+            )
+
+        # In streaming the decoder gets all latents generated so far, so give TensorRT one profile spanning every
+        # length the GPT can produce; otherwise each new length outside the current profile rebuilds the engine.
+        # That single engine is cached on disk, so a restart does not build it again.
+        latent_dim = config.model_args.decoder_input_dim
+        g_shape = f"g:1x{config.model_args.d_vector_dim}x1"
+        max_latents = config.model_args.gpt_max_audio_tokens
+        trt_session = onnxruntime.InferenceSession(
+            onnx_path,
+            providers=[
+                (
+                    "TensorrtExecutionProvider",
+                    {
+                        "trt_fp16_enable": True,
+                        "trt_engine_cache_enable": True,
+                        "trt_engine_cache_path": os.path.join(model_path, "trt_cache"),
+                        "trt_profile_min_shapes": f"latents:1x1x{latent_dim},{g_shape}",
+                        "trt_profile_opt_shapes": f"latents:1x{max_latents // 2}x{latent_dim},{g_shape}",
+                        "trt_profile_max_shapes": f"latents:1x{max_latents}x{latent_dim},{g_shape}",
+                    },
+                ),
+                "CUDAExecutionProvider",
+            ],
+        )
+
+        def _trt_hifigan_forward(latents, g=None):
+            wav = trt_session.run(
+                None,
+                {"latents": latents.float().cpu().numpy(), "g": g.float().cpu().numpy()},
+            )[0]
+            return torch.from_numpy(wav).to(latents.device)
+
+        model.hifigan_decoder.forward = _trt_hifigan_forward
+
+    return model
+
+
+# Run short syntheses through the same streaming path as predict at startup, so the first user does not pay
+# for cuDNN benchmarking, torch.compile codegen or deepspeed kernel builds. The second pass picks up
+# whatever the first one only triggered (e.g. recompiles once a dimension is seen to vary).
+def _warmup():
+    print("Warming up XTTS")
+    warmup_latents = _get_latents("examples/female.wav", _file_digest("examples/female.wav"))
+    with torch.inference_mode(), torch.autocast("cuda", dtype=torch.float16):
+        for _ in range(2):
+            for _chunk in model.inference_stream("Warmup.", "en", *warmup_latents, stream_chunk_size=20):
+                pass
+    torch.cuda.synchronize()
+    # hand back what the warmup passes cached so the first real request starts from a clean pool
+    torch.cuda.empty_cache()
+    print("XTTS warmed up")
+
+
+model = None
+model_lock = threading.Lock()
+
+
+def get_model():
+    """Load, warm up and start serving XTTS on first use, so merely importing app (e.g. a health check) stays cheap"""
+    global model
+    with model_lock:
+        if model is None:
+            # _warmup and _get_latents use the global, so it is set first and reset if any later step fails.
+            # Otherwise the next call would see a model without a worker and block forever in synthesize
+            model = load_model()
+            try:
+                _warmup()
+                for wav in ["examples/female.wav", "examples/male.wav"]:
+                    digest = _file_digest(wav)
+                    PRECOMPUTED[digest] = PRECOMPUTED[_gradio_reference_digest(wav)] = _get_latents(wav, digest)
+                threading.Thread(target=_inference_worker, daemon=True).start()
+            except Exception:
+                model = None
+                PRECOMPUTED.clear()
+                latents_cache.clear()
+                raise
+    return model
+
+
+def waveform_image(wav, sample_rate=24000):
+    """Draw the waveform with matplotlib, much cheaper than rendering a video with ffmpeg"""
+    wav = wav.numpy()
+    # a standalone Figure instead of pyplot, whose global figure state is not safe across the queue threads
+    fig = Figure(figsize=(8, 2))
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.subplots()
+    ax.fill_between(np.arange(len(wav)) / sample_rate, np.abs(wav), -np.abs(wav), linewidth=0)
+    ax.axis("off")
+    fig.tight_layout(pad=0)
+    canvas.draw()
+    return np.asarray(canvas.buffer_rgba())[..., :3].copy()
+
+
+def synthesize(prompt, language, speaker_wav):
+    """Queue a request for the GPU worker and yield its audio chunks as they are generated"""
+    chunk_queue = queue.Queue()
+    cancelled = threading.Event()
+    inference_queue.put((prompt, language, speaker_wav, chunk_queue, cancelled))
+    try:
+        while True:
+            chunk = chunk_queue.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        # also runs when predict is closed early, which tells the worker to stop generating
+        cancelled.set()
 
 def predict(
     prompt,
@@ -87,133 +474,223 @@ def predict(
     no_lang_auto_detect,
     agree,
 ):
-    if agree == True:
-        if language not in supported_languages:
+    # the Send button is only enabled once the terms are accepted, this check covers calls through the API
+    if agree != True:
+        gr.Warning("Please accept the Terms & Condition!")
+        yield (
+            None,
+            None,
+            None,
+            None,
+        )
+        return
+
+    supported_languages = get_model().config.languages
+    if language not in supported_languages:
+        gr.Warning(
+            f"Language you put {language} in is not in is not in our Supported Languages, please choose from dropdown"
+        )
+
+        yield (
+            None,
+            None,
+            None,
+            None,
+        )
+        return
+
+    language_predicted = langid.classify(prompt)[
+        0
+    ].strip()  # strip need as there is space at end!
+
+    # tts expects chinese as zh-cn
+    if language_predicted == "zh":
+        # we use zh-cn
+        language_predicted = "zh-cn"
+
+    print(f"Detected language:{language_predicted}, Chosen language:{language}")
+
+    # After text character length 15 trigger language detection
+    if len(prompt) > 15:
+        # allow any language for short text as some may be common
+        # If user unchecks language autodetection it will not trigger
+        # You may remove this completely for own use
+        if language_predicted != language and not no_lang_auto_detect:
+            # Please duplicate and remove this check if you really want this
+            # Or auto-detector fails to identify language (which it can on pretty short text or mixed text)
             gr.Warning(
-                f"Language you put {language} in is not in is not in our Supported Languages, please choose from dropdown"
+                f"It looks like your text isn’t the language you chose , if you’re sure the text is the same language you chose, please check disable language auto-detection checkbox"
             )
 
-            return (
+            yield (
                 None,
                 None,
                 None,
                 None,
             )
+            return
 
-        language_predicted = langid.classify(prompt)[
-            0
-        ].strip()  # strip need as there is space at end!
-
-        # tts expects chinese as zh-cn
-        if language_predicted == "zh":
-            # we use zh-cn
-            language_predicted = "zh-cn"
-
-        print(f"Detected language:{language_predicted}, Chosen language:{language}")
-
-        # After text character length 15 trigger language detection
-        if len(prompt) > 15:
-            # allow any language for short text as some may be common
-            # If user unchecks language autodetection it will not trigger
-            # You may remove this completely for own use
-            if language_predicted != language and not no_lang_auto_detect:
-                # Please duplicate and remove this check if you really want this
-                # Or auto-detector fails to identify language (which it can on pretty short text or mixed text)
-                gr.Warning(
-                    f"It looks like your text isn’t the language you chose , if you’re sure the text is the same language you chose, please check disable language auto-detection checkbox"
-                )
-
-                return (
-                    None,
-                    None,
-                    None,
-                    None,
-                )
-
-        if use_mic == True:
-            if mic_file_path is not None:
-                speaker_wav = mic_file_path
-            else:
-                gr.Warning(
-                    "Please record your voice with Microphone, or uncheck Use Microphone to use reference audios"
-                )
-                return (
-                    None,
-                    None,
-                    None,
-                    None,
-                )
-
-        else:
-            speaker_wav = audio_file_pth
-
-        # Filtering for microphone input, as it has BG noise, maybe silence in beginning and end
-        # This is fast filtering not perfect
-
-        # Apply all on demand
-        lowpassfilter = denoise = trim = loudness = True
-
-        if lowpassfilter:
-            lowpass_highpass = "lowpass=8000,highpass=75,"
+    if use_mic == True:
+        if mic_file_path is not None:
+            speaker_wav = mic_file_path
         else:
-            lowpass_highpass = ""
+            gr.Warning(
+                "Please record your voice with Microphone, or uncheck Use Microphone to use reference audios"
+            )
+            yield (
+                None,
+                None,
+                None,
+                None,
+            )
+            return
 
-        if trim:
-            # better to remove silence in beginning and end for microphone
-            trim_silence = "areverse,silenceremove=start_periods=1:start_silence=0:start_threshold=0.02,areverse,silenceremove=start_periods=1:start_silence=0:start_threshold=0.02,"
-        else:
-            trim_silence = ""
+    else:
+        speaker_wav = audio_file_pth
 
-        if voice_cleanup:
-            try:
-                out_filename = (
-                    speaker_wav + str(uuid.uuid4()) + ".wav"
-                )  # ffmpeg to know output format
+    if voice_cleanup:
+        try:
+            speaker_wav = _cleanup_reference(speaker_wav, _file_digest(speaker_wav))
+            print("Filtered microphone input")
+        except subprocess.CalledProcessError:
+            # There was an error - command exited with non-zero code
+            print("Error: failed filtering, use original microphone input")
+    else:
+        speaker_wav = speaker_wav
 
-                # we will use newer ffmpeg as that has afftn denoise filter
-                shell_command = f"./ffmpeg -y -i {speaker_wav} -af {lowpass_highpass}{trim_silence} {out_filename}".split(
-                    " "
-                )
+    if len(prompt) < 2:
+        gr.Warning("Please give a longer prompt text")
+        yield (
+            None,
+            None,
+            None,
+            None,
+        )
+        return
+    if len(prompt) > 200:
+        gr.Warning(
+            "Text length limited to 200 characters for this demo, please try shorter text. You can clone this space and edit code for your own usage"
+        )
+        yield (
+            None,
+            None,
+            None,
+            None,
+        )
+        return
+    global DEVICE_ASSERT_DETECTED
+    if DEVICE_ASSERT_DETECTED:
+        global DEVICE_ASSERT_PROMPT
+        global DEVICE_ASSERT_LANG
+        # It will likely never come here as we restart space on first unrecoverable error now
+        print(
+            f"Unrecoverable exception caused by language:{DEVICE_ASSERT_LANG} prompt:{DEVICE_ASSERT_PROMPT}"
+        )
 
-                command_result = subprocess.run(
-                    [item for item in shell_command],
-                    capture_output=False,
-                    text=True,
-                    check=True,
-                )
-                speaker_wav = out_filename
-                print("Filtered microphone input")
-            except subprocess.CalledProcessError:
-                # There was an error - command exited with non-zero code
-                print("Error: failed filtering, use original microphone input")
+        # HF Space specific.. This error is unrecoverable need to restart space
+        space = api.get_space_runtime(repo_id=repo_id)
+        if space.stage!="BUILDING":
+            api.restart_space(repo_id=repo_id)
         else:
-            speaker_wav = speaker_wav
-
-        if len(prompt) < 2:
-            gr.Warning("Please give a longer prompt text")
-            return (
-                None,
+            print("TRIED TO RESTART but space is building")
+
+    try:
+        metrics_text = ""
+
+        # temporary comma fix
+        prompt= re.sub("([^\x00-\x7F]|\w)(\.|\。|\?)",r"\1 \2\2",prompt)
+
+        print("I: Generating new audio in streaming mode...")
+        t0 = time.time()
+        wav_chunks = []
+        for i, chunk in enumerate(synthesize(prompt, language, speaker_wav)):
+            if i == 0:
+                first_chunk_time = time.time() - t0
+                metrics_text += f"Latency to first audio chunk: {round(first_chunk_time*1000)} milliseconds\n"
+            wav_chunks.append(chunk)
+            yield (
                 None,
+                (24000, (chunk.clamp(-1, 1) * 32767).to(torch.int16).numpy()),
                 None,
                 None,
             )
-        if len(prompt) > 200:
-            gr.Warning(
-                "Text length limited to 200 characters for this demo, please try shorter text. You can clone this space and edit code for your own usage"
+        inference_time = time.time() - t0
+        print(f"I: Time to generate audio: {round(inference_time*1000)} milliseconds")
+        metrics_text+=f"Time to generate audio: {round(inference_time*1000)} milliseconds\n"
+
+        wav = torch.cat(wav_chunks, dim=0)
+        real_time_factor= inference_time / wav.shape[0] * 24000
+        print(f"Real-time factor (RTF): {real_time_factor}")
+        metrics_text+=f"Real-time factor (RTF): {real_time_factor:.2f}\n"
+
+    except SpeakerEncodingError as e:
+        print("Speaker encoding error", str(e))
+        gr.Warning(
+            "It appears something wrong with reference, did you unmute your microphone?"
+        )
+        yield (
+            None,
+            None,
+            None,
+            None,
+        )
+        return
+    except RuntimeError as e:
+        if "device-side assert" in str(e):
+            # cannot do anything on cuda device side error, need tor estart
+            print(
+                f"Exit due to: Unrecoverable exception caused by language:{language} prompt:{prompt}",
+                flush=True,
             )
-            return (
-                None,
-                None,
-                None,
-                None,
+            gr.Warning("Unhandled Exception encounter, please retry in a minute")
+            print("Cuda device-assert Runtime encountered need restart")
+            if not DEVICE_ASSERT_DETECTED:
+                DEVICE_ASSERT_DETECTED = 1
+                DEVICE_ASSERT_PROMPT = prompt
+                DEVICE_ASSERT_LANG = language
+
+            # just before restarting save what caused the issue so we can handle it in future
+            # Uploading Error data only happens for unrecovarable error
+            error_time = datetime.datetime.now().strftime("%d-%m-%Y-%H:%M:%S")
+            error_data = [
+                error_time,
+                prompt,
+                language,
+                audio_file_pth,
+                mic_file_path,
+                use_mic,
+                voice_cleanup,
+                no_lang_auto_detect,
+                agree,
+            ]
+            error_data = [str(e) if type(e) != str else e for e in error_data]
+            print(error_data)
+            print(speaker_wav)
+            write_io = StringIO()
+            csv.writer(write_io).writerows([error_data])
+            csv_upload = write_io.getvalue().encode()
+
+            filename = error_time + "_" + str(uuid.uuid4()) + ".csv"
+            print("Writing error csv")
+            error_api = HfApi()
+            error_api.upload_file(
+                path_or_fileobj=csv_upload,
+                path_in_repo=filename,
+                repo_id="coqui/xtts-flagged-dataset",
+                repo_type="dataset",
             )
-        global DEVICE_ASSERT_DETECTED
-        if DEVICE_ASSERT_DETECTED:
-            global DEVICE_ASSERT_PROMPT
-            global DEVICE_ASSERT_LANG
-            # It will likely never come here as we restart space on first unrecoverable error now
-            print(
-                f"Unrecoverable exception caused by language:{DEVICE_ASSERT_LANG} prompt:{DEVICE_ASSERT_PROMPT}"
+
+            # speaker_wav
+            print("Writing error reference audio")
+            speaker_filename = (
+                error_time + "_reference_" + str(uuid.uuid4()) + ".wav"
+            )
+            error_api = HfApi()
+            error_api.upload_file(
+                path_or_fileobj=speaker_wav,
+                path_in_repo=speaker_filename,
+                repo_id="coqui/xtts-flagged-dataset",
+                repo_type="dataset",
             )
 
             # HF Space specific.. This error is unrecoverable need to restart space
@@ -222,190 +699,30 @@ def predict(
                 api.restart_space(repo_id=repo_id)
             else:
                 print("TRIED TO RESTART but space is building")
-
-        try:
-            metrics_text = ""
-            t_latent = time.time()
-
-            # note diffusion_conditioning not used on hifigan (default mode), it will be empty but need to pass it to model.inference
-            try:
-                (
-                    gpt_cond_latent,
-                    speaker_embedding,
-                ) = model.get_conditioning_latents(audio_path=speaker_wav, gpt_cond_len=30, gpt_cond_chunk_len=4, max_ref_length=60)
-            except Exception as e:
+                
+        else:
+            if "Failed to decode" in str(e):
                 print("Speaker encoding error", str(e))
                 gr.Warning(
                     "It appears something wrong with reference, did you unmute your microphone?"
                 )
-                return (
-                    None,
-                    None,
-                    None,
-                    None,
-                )
-
-            latent_calculation_time = time.time() - t_latent
-            # metrics_text=f"Embedding calculation time: {latent_calculation_time:.2f} seconds\n"
-
-            # temporary comma fix
-            prompt= re.sub("([^\x00-\x7F]|\w)(\.|\。|\?)",r"\1 \2\2",prompt)
-
-            wav_chunks = []
-            ## Direct mode
-            
-            print("I: Generating new audio...")
-            t0 = time.time()
-            out = model.inference(
-                prompt,
-                language,
-                gpt_cond_latent,
-                speaker_embedding,
-                repetition_penalty=5.0,
-                temperature=0.75,
-            )
-            inference_time = time.time() - t0
-            print(f"I: Time to generate audio: {round(inference_time*1000)} milliseconds")
-            metrics_text+=f"Time to generate audio: {round(inference_time*1000)} milliseconds\n"
-            real_time_factor= (time.time() - t0) / out['wav'].shape[-1] * 24000
-            print(f"Real-time factor (RTF): {real_time_factor}")
-            metrics_text+=f"Real-time factor (RTF): {real_time_factor:.2f}\n"
-            torchaudio.save("output.wav", torch.tensor(out["wav"]).unsqueeze(0), 24000)
-
-
-            """
-            print("I: Generating new audio in streaming mode...")
-            t0 = time.time()
-            chunks = model.inference_stream(
-                prompt,
-                language,
-                gpt_cond_latent,
-                speaker_embedding,
-                repetition_penalty=7.0,
-                temperature=0.85,
-            )
-
-            first_chunk = True
-            for i, chunk in enumerate(chunks):
-                if first_chunk:
-                    first_chunk_time = time.time() - t0
-                    metrics_text += f"Latency to first audio chunk: {round(first_chunk_time*1000)} milliseconds\n"
-                    first_chunk = False
-                wav_chunks.append(chunk)
-                print(f"Received chunk {i} of audio length {chunk.shape[-1]}")
-            inference_time = time.time() - t0
-            print(
-                f"I: Time to generate audio: {round(inference_time*1000)} milliseconds"
-            )
-            #metrics_text += (
-            #    f"Time to generate audio: {round(inference_time*1000)} milliseconds\n"
-            #)
-
-            wav = torch.cat(wav_chunks, dim=0)
-            print(wav.shape)
-            real_time_factor = (time.time() - t0) / wav.shape[0] * 24000
-            print(f"Real-time factor (RTF): {real_time_factor}")
-            metrics_text += f"Real-time factor (RTF): {real_time_factor:.2f}\n"
-
-            torchaudio.save("output.wav", wav.squeeze().unsqueeze(0).cpu(), 24000)
-            """
-
-        except RuntimeError as e:
-            if "device-side assert" in str(e):
-                # cannot do anything on cuda device side error, need tor estart
-                print(
-                    f"Exit due to: Unrecoverable exception caused by language:{language} prompt:{prompt}",
-                    flush=True,
-                )
-                gr.Warning("Unhandled Exception encounter, please retry in a minute")
-                print("Cuda device-assert Runtime encountered need restart")
-                if not DEVICE_ASSERT_DETECTED:
-                    DEVICE_ASSERT_DETECTED = 1
-                    DEVICE_ASSERT_PROMPT = prompt
-                    DEVICE_ASSERT_LANG = language
-
-                # just before restarting save what caused the issue so we can handle it in future
-                # Uploading Error data only happens for unrecovarable error
-                error_time = datetime.datetime.now().strftime("%d-%m-%Y-%H:%M:%S")
-                error_data = [
-                    error_time,
-                    prompt,
-                    language,
-                    audio_file_pth,
-                    mic_file_path,
-                    use_mic,
-                    voice_cleanup,
-                    no_lang_auto_detect,
-                    agree,
-                ]
-                error_data = [str(e) if type(e) != str else e for e in error_data]
-                print(error_data)
-                print(speaker_wav)
-                write_io = StringIO()
-                csv.writer(write_io).writerows([error_data])
-                csv_upload = write_io.getvalue().encode()
-
-                filename = error_time + "_" + str(uuid.uuid4()) + ".csv"
-                print("Writing error csv")
-                error_api = HfApi()
-                error_api.upload_file(
-                    path_or_fileobj=csv_upload,
-                    path_in_repo=filename,
-                    repo_id="coqui/xtts-flagged-dataset",
-                    repo_type="dataset",
-                )
-
-                # speaker_wav
-                print("Writing error reference audio")
-                speaker_filename = (
-                    error_time + "_reference_" + str(uuid.uuid4()) + ".wav"
-                )
-                error_api = HfApi()
-                error_api.upload_file(
-                    path_or_fileobj=speaker_wav,
-                    path_in_repo=speaker_filename,
-                    repo_id="coqui/xtts-flagged-dataset",
-                    repo_type="dataset",
-                )
-
-                # HF Space specific.. This error is unrecoverable need to restart space
-                space = api.get_space_runtime(repo_id=repo_id)
-                if space.stage!="BUILDING":
-                    api.restart_space(repo_id=repo_id)
-                else:
-                    print("TRIED TO RESTART but space is building")
-                    
             else:
-                if "Failed to decode" in str(e):
-                    print("Speaker encoding error", str(e))
-                    gr.Warning(
-                        "It appears something wrong with reference, did you unmute your microphone?"
-                    )
-                else:
-                    print("RuntimeError: non device-side assert error:", str(e))
-                    gr.Warning("Something unexpected happened please retry again.")
-                return (
-                    None,
-                    None,
-                    None,
-                    None,
-                )
-        return (
-            gr.make_waveform(
-                audio="output.wav",
-            ),
-            "output.wav",
-            metrics_text,
-            speaker_wav,
-        )
-    else:
-        gr.Warning("Please accept the Terms & Condition!")
-        return (
+                print("RuntimeError: non device-side assert error:", str(e))
+                gr.Warning("Something unexpected happened please retry again.")
+        yield (
             None,
             None,
             None,
             None,
         )
+        return
+    # audio was already streamed, only fill in the remaining outputs
+    yield (
+        waveform_image(wav),
+        None,
+        metrics_text,
+        speaker_wav,
+    )
 
 
 title = "Coqui🐸 XTTS"
@@ -597,107 +914,117 @@ examples = [
 
 
 
-with gr.Blocks(analytics_enabled=False) as demo:
-    with gr.Row():
-        with gr.Column():
-            gr.Markdown(
-                """
-                ## <img src="https://raw.githubusercontent.com/coqui-ai/TTS/main/images/coqui-log-green-TTS.png" height="56"/>
-                """
-            )
-        with gr.Column():
-            # placeholder to align the image
-            pass
-
-    with gr.Row():
-        with gr.Column():
-            gr.Markdown(description)
-        with gr.Column():
-            gr.Markdown(links)
-
-    with gr.Row():
-        with gr.Column():
-            input_text_gr = gr.Textbox(
-                label="Text Prompt",
-                info="One or two sentences at a time is better. Up to 200 text characters.",
-                value="Hi there, I'm your new voice clone. Try your best to upload quality audio.",
-            )
-            language_gr = gr.Dropdown(
-                label="Language",
-                info="Select an output language for the synthesised speech",
-                choices=[
-                    "en",
-                    "es",
-                    "fr",
-                    "de",
-                    "it",
-                    "pt",
-                    "pl",
-                    "tr",
-                    "ru",
-                    "nl",
-                    "cs",
-                    "ar",
-                    "zh-cn",
-                    "ja",
-                    "ko",
-                    "hu",
-                    "hi"
-                ],
-                max_choices=1,
-                value="en",
-            )
-            ref_gr = gr.Audio(
-                label="Reference Audio",
-                info="Click on the ✎ button to upload your own target speaker audio",
-                type="filepath",
-                value="examples/female.wav",
-            )
-            mic_gr = gr.Audio(
-                source="microphone",
-                type="filepath",
-                info="Use your microphone to record audio",
-                label="Use Microphone for Reference",
-            )
-            use_mic_gr = gr.Checkbox(
-                label="Use Microphone",
-                value=False,
-                info="Notice: Microphone input may not work properly under traffic",
-            )
-            clean_ref_gr = gr.Checkbox(
-                label="Cleanup Reference Voice",
-                value=False,
-                info="This check can improve output if your microphone or reference voice is noisy",
-            )
-            auto_det_lang_gr = gr.Checkbox(
-                label="Do not use language auto-detect",
-                value=False,
-                info="Check to disable language auto-detection",
-            )
-            tos_gr = gr.Checkbox(
-                label="Agree",
-                value=False,
-                info="I agree to the terms of the CPML: https://coqui.ai/cpml",
-            )
+def build_app():
+    with gr.Blocks(analytics_enabled=False) as demo:
+        with gr.Row():
+            with gr.Column():
+                gr.Markdown(
+                    """
+                    ## <img src="https://raw.githubusercontent.com/coqui-ai/TTS/main/images/coqui-log-green-TTS.png" height="56"/>
+                    """
+                )
+            with gr.Column():
+                # placeholder to align the image
+                pass
+
+        with gr.Row():
+            with gr.Column():
+                gr.Markdown(description)
+            with gr.Column():
+                gr.Markdown(links)
+
+        with gr.Row():
+            with gr.Column():
+                input_text_gr = gr.Textbox(
+                    label="Text Prompt",
+                    info="One or two sentences at a time is better. Up to 200 text characters.",
+                    value="Hi there, I'm your new voice clone. Try your best to upload quality audio.",
+                )
+                language_gr = gr.Dropdown(
+                    label="Language",
+                    info="Select an output language for the synthesised speech",
+                    choices=[
+                        "en",
+                        "es",
+                        "fr",
+                        "de",
+                        "it",
+                        "pt",
+                        "pl",
+                        "tr",
+                        "ru",
+                        "nl",
+                        "cs",
+                        "ar",
+                        "zh-cn",
+                        "ja",
+                        "ko",
+                        "hu",
+                        "hi"
+                    ],
+                    max_choices=1,
+                    value="en",
+                )
+                ref_gr = gr.Audio(
+                    label="Reference Audio",
+                    info="Click on the ✎ button to upload your own target speaker audio",
+                    type="filepath",
+                    value="examples/female.wav",
+                )
+                mic_gr = gr.Audio(
+                    source="microphone",
+                    type="filepath",
+                    info="Use your microphone to record audio",
+                    label="Use Microphone for Reference",
+                )
+                use_mic_gr = gr.Checkbox(
+                    label="Use Microphone",
+                    value=False,
+                    info="Notice: Microphone input may not work properly under traffic",
+                )
+                clean_ref_gr = gr.Checkbox(
+                    label="Cleanup Reference Voice",
+                    value=False,
+                    info="This check can improve output if your microphone or reference voice is noisy",
+                )
+                auto_det_lang_gr = gr.Checkbox(
+                    label="Do not use language auto-detect",
+                    value=False,
+                    info="Check to disable language auto-detection",
+                )
+                tos_gr = gr.Checkbox(
+                    label="Agree",
+                    value=False,
+                    info="I agree to the terms of the CPML: https://coqui.ai/cpml",
+                )
+
+                # the button only becomes clickable once the terms are accepted
+                tts_button = gr.Button("Send", elem_id="send-btn", visible=True, interactive=False)
+                tos_gr.change(lambda agree: gr.update(interactive=agree), inputs=tos_gr, outputs=tts_button, queue=False)
+
 
-            tts_button = gr.Button("Send", elem_id="send-btn", visible=True)
+            with gr.Column():
+                waveform_gr = gr.Image(label="Waveform Visual", type="numpy")
+                audio_gr = gr.Audio(label="Synthesised Audio", autoplay=True, streaming=True)
+                out_text_gr = gr.Text(label="Metrics")
+                ref_audio_gr = gr.Audio(label="Reference Audio Used")
 
+        with gr.Row():
+            gr.Examples(examples,
+                        label="Examples",
+                        inputs=[input_text_gr, language_gr, ref_gr, mic_gr, use_mic_gr, clean_ref_gr, auto_det_lang_gr, tos_gr],
+                        outputs=[waveform_gr, audio_gr, out_text_gr, ref_audio_gr],
+                        fn=predict,
+                        cache_examples=False,)
 
-        with gr.Column():
-            video_gr = gr.Video(label="Waveform Visual")
-            audio_gr = gr.Audio(label="Synthesised Audio", autoplay=True)
-            out_text_gr = gr.Text(label="Metrics")
-            ref_audio_gr = gr.Audio(label="Reference Audio Used")
+        tts_button.click(predict, [input_text_gr, language_gr, ref_gr, mic_gr, use_mic_gr, clean_ref_gr, auto_det_lang_gr, tos_gr], outputs=[waveform_gr, audio_gr, out_text_gr, ref_audio_gr])
 
-    with gr.Row():
-        gr.Examples(examples,
-                    label="Examples",
-                    inputs=[input_text_gr, language_gr, ref_gr, mic_gr, use_mic_gr, clean_ref_gr, auto_det_lang_gr, tos_gr],
-                    outputs=[video_gr, audio_gr, out_text_gr, ref_audio_gr],
-                    fn=predict,
-                    cache_examples=False,)
+    return demo
 
-    tts_button.click(predict, [input_text_gr, language_gr, ref_gr, mic_gr, use_mic_gr, clean_ref_gr, auto_det_lang_gr, tos_gr], outputs=[video_gr, audio_gr, out_text_gr, ref_audio_gr])
 
-demo.queue()  
-demo.launch(debug=True, show_api=True)
\ No newline at end of file
+if __name__ == "__main__":
+    # load eagerly when serving, so the first user does not wait for the model
+    get_model()
+    demo = build_app()
+    demo.queue(concurrency_count=QUEUE_CONCURRENCY)
+    demo.launch(debug=True, show_api=True)